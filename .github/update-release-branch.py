@@ -1,11 +1,15 @@
 import argparse
 import datetime
 import fileinput
+import functools
 import re
-from github import Github
+from github import Github, GithubException
 import json
-import os
+import pathlib
+import requests
+import shlex
 import subprocess
+from urllib3.util import Retry
 
 EMPTY_CHANGELOG = """# CodeQL Action Changelog
 
@@ -22,90 +26,261 @@ BACKPORT_COMMIT_MESSAGE = 'Update version and changelog for v'
 # Name of the remote
 ORIGIN = 'origin'
 
+# Matches the PR number that GitHub appends to the subject line of squash and
+# merge commits, e.g. "Some change (#123)".
+PR_NUMBER_RE = re.compile(r'\(#(\d+)\)\s*$')
+
+# URL of the GitHub GraphQL API
+GRAPHQL_API_URL = 'https://api.github.com/graphql'
+
+# Number of commits to look up in each GraphQL request. Each commit becomes an
+# aliased field in the query, so this bounds the size of a single request.
+GRAPHQL_COMMIT_BATCH_SIZE = 50
+
+# GraphQL fragment selecting the commit fields that we use below.
+COMMIT_INFO_FRAGMENT = """
+fragment commitInfo on Commit {
+  oid
+  message
+  author {
+    user {
+      login
+    }
+    date
+  }
+  associatedPullRequests(first: 5) {
+    nodes {
+      number
+      mergeCommit {
+        author {
+          user {
+            login
+          }
+        }
+      }
+    }
+  }
+}
+"""
+
+# Timeout in seconds for each GraphQL request, so a stalled connection fails
+# the request rather than hanging the release job.
+GRAPHQL_TIMEOUT_SECONDS = 15
+
+# Session reused across GraphQL requests, so the batched queries share one
+# connection instead of opening a new one per batch. Retries with backoff on
+# transient server errors and secondary rate limits (429, which urllib3 backs
+# off from while honoring any Retry-After header). allowed_methods=None makes
+# the policy apply to POST, which urllib3 excludes by default; that is safe
+# here since GraphQL queries are read-only. 403 is deliberately not in the
+# list: a genuine permission failure should surface immediately rather than
+# burn a minute of backoff first.
+GRAPHQL_SESSION = requests.Session()
+GRAPHQL_SESSION.mount('https://', requests.adapters.HTTPAdapter(
+  max_retries=Retry(total=5, backoff_factor=2, status_forcelist=[429, 500, 502, 503, 504],
+                    allowed_methods=None)))
+
+# Runs the given query against the GitHub GraphQL API and returns the data
+# from the response.
+def run_graphql_query(github_token, query):
+  response = GRAPHQL_SESSION.post(
+    GRAPHQL_API_URL,
+    json={'query': query},
+    headers={'Authorization': f'Bearer {github_token}'},
+    timeout=GRAPHQL_TIMEOUT_SECONDS,
+  )
+  response.raise_for_status()
+  result = response.json()
+  if 'errors' in result:
+    raise Exception(f'GraphQL query failed: {result["errors"]}')
+  return result['data']
+
+# Looks up the given commit SHAs and returns a commit record for each one.
+# GraphQL aliases let us fetch a whole batch of commits, along with their
+# associated pull requests and the users who merged those pull requests, in a
+# single request, rather than making several REST calls per commit.
+def get_commits(github_token, repository_nwo, shas):
+  owner, name = repository_nwo.split('/')
+  commits = []
+  for i in range(0, len(shas), GRAPHQL_COMMIT_BATCH_SIZE):
+    batch = shas[i:i + GRAPHQL_COMMIT_BATCH_SIZE]
+    fields = ' '.join(f'c{j}: object(expression: "{sha}") {{ ...commitInfo }}' for j, sha in enumerate(batch))
+    query = f'{{ repository(owner: "{owner}", name: "{name}") {{ {fields} }} }}{COMMIT_INFO_FRAGMENT}'
+    repository = run_graphql_query(github_token, query)['repository']
+    for j, sha in enumerate(batch):
+      node = repository[f'c{j}']
+      if node is None:
+        raise Exception(f'Could not find commit {sha} in {repository_nwo}.')
+      commits.append(commit_record(node))
+  return commits
+
+# Flattens a GraphQL commit node into a record with the fields we use below.
+# In the case that a commit is associated with multiple pull requests, the
+# earliest one is used. The merger of a pull request is the author of its
+# merge commit. For most cases this will be the same as the PR author, but for
+# PRs opened by external contributors this will get us the GitHub employee who
+# reviewed and merged the PR.
+def commit_record(node):
+  author = node['author'] or {}
+  author_user = author.get('user') or {}
+  prs = node['associatedPullRequests']['nodes']
+  pr = min(prs, key=lambda pr: pr['number']) if prs else None
+  pr_number = pr['number'] if pr is not None else None
+  merger = None
+  if pr is not None and pr['mergeCommit'] is not None:
+    merger = ((pr['mergeCommit']['author'] or {}).get('user') or {}).get('login')
+  if pr_number is None:
+    # In the rare case that the API doesn't associate the commit with a PR,
+    # fall back to parsing the PR number that GitHub appends to the subject
+    # line of squash and merge commits. We don't have the PR's merge commit
+    # here, so attribute the PR to the commit author.
+    match = PR_NUMBER_RE.search(node['message'].partition('\n')[0])
+    if match:
+      pr_number = int(match.group(1))
+      merger = author_user.get('login')
+  return {
+    'sha': node['oid'],
+    'message': node['message'],
+    'author_login': author_user.get('login'),
+    'author_date': author.get('date'),
+    'pr_number': pr_number,
+    'pr_merger': merger,
+  }
+
 # Runs git with the given args and returns the stdout.
 # Raises an error if git does not exit successfully (unless passed
 # allow_non_zero_exit_code=True).
+# NB: the output is deliberately not cached: this script checks out, reverts,
+# merges, and commits as it runs, so the output of commands like `log` and
+# `rev-parse` is not a pure function of their arguments.
 def run_git(*args, allow_non_zero_exit_code=False):
   cmd = ['git', *args]
   p = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
   if not allow_non_zero_exit_code and p.returncode != 0:
-    raise Exception(f'Call to {" ".join(cmd)} exited with code {p.returncode} stderr: {p.stderr.decode("ascii")}.')
+    # stderr is only decoded here on the error path; successful calls never pay for it
+    raise Exception(f'Call to {" ".join(cmd)} exited with code {p.returncode} stderr: {p.stderr.decode("ascii", "replace")}.')
   return p.stdout.decode('ascii')
 
-# Returns true if the given branch exists on the origin remote
-def branch_exists_on_remote(branch_name):
-  return run_git('ls-remote', '--heads', ORIGIN, branch_name).strip() != ''
+# Runs git with the given args and returns an iterator over the lines of its
+# stdout. Unlike run_git, the output is streamed rather than buffered fully in
+# memory, so callers that only need the first few lines don't pay to decode
+# the whole output. Raises an error if git does not exit successfully.
+def run_git_lines(*args):
+  cmd = ['git', *args]
+  with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                        text=True, encoding='ascii', bufsize=1) as p:
+    for line in p.stdout:
+      yield line.rstrip('\n')
+    stderr = p.stderr.read()
+  if p.returncode != 0:
+    raise Exception(f'Call to {" ".join(cmd)} exited with code {p.returncode} stderr: {stderr}.')
+
+# Delimiter separating the output of the individual commands run by run_git_script
+GIT_SCRIPT_SEPARATOR = '---SEP---'
+
+# Runs several git commands in a single shell invocation, avoiding the
+# fork+exec overhead of spawning a separate process per command. Takes the
+# argument list for each command and returns the corresponding list of
+# outputs. Raises an error if any of the commands does not exit successfully.
+def run_git_script(*git_commands):
+  # Quote each argument so that branch names containing shell metacharacters
+  # can't break the script or be interpreted by the shell.
+  script = f' && echo {GIT_SCRIPT_SEPARATOR} && '.join(
+    'git ' + ' '.join(shlex.quote(arg) for arg in args) for args in git_commands)
+  p = subprocess.run(['bash', '-c', script], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+  if p.returncode != 0:
+    raise Exception(f'Call to {script} exited with code {p.returncode} stderr: {p.stderr.decode("ascii", "replace")}.')
+  return p.stdout.decode('ascii').split(f'{GIT_SCRIPT_SEPARATOR}\n')
+
+# Returns true if the given branch exists on the remote repository.
+# Checked via the API rather than git ls-remote, which would spawn another git
+# process and make its own network round trip to the remote.
+def branch_exists_on_remote(repo, branch_name):
+  try:
+    repo.get_branch(branch_name)
+    return True
+  except GithubException as e:
+    if e.status == 404:
+      return False
+    raise
 
 # Opens a PR from the given branch to the target branch
 def open_pr(
   repo, all_commits, source_branch_short_sha, new_branch_name, source_branch, target_branch,
   conductor, is_primary_release, conflicted_files):
   # Sort the commits into the pull requests that introduced them,
-  # and any commits that don't have a pull request
-  pull_requests = []
+  # and any commits that don't have a pull request. Keying the pull requests
+  # by number deduplicates the commits that belong to the same PR in constant
+  # time.
+  pull_requests_by_number = {}
   commits_without_pull_requests = []
   for commit in all_commits:
-    pr = get_pr_for_commit(commit)
-
-    if pr is None:
+    if commit['pr_number'] is None:
       commits_without_pull_requests.append(commit)
-    elif not any(p for p in pull_requests if p.number == pr.number):
-      pull_requests.append(pr)
+    elif commit['pr_number'] not in pull_requests_by_number:
+      pull_requests_by_number[commit['pr_number']] = commit
 
-  print(f'Found {len(pull_requests)} pull requests.')
+  print(f'Found {len(pull_requests_by_number)} pull requests.')
   print(f'Found {len(commits_without_pull_requests)} commits not in a pull request.')
 
   # Sort PRs and commits by age
-  pull_requests = sorted(pull_requests, key=lambda pr: pr.number)
-  commits_without_pull_requests = sorted(commits_without_pull_requests, key=lambda c: c.commit.author.date)
-
-  # Start constructing the body text
-  body = []
-  body.append(f'Merging {source_branch_short_sha} into `{target_branch}`.')
+  pull_requests = sorted(pull_requests_by_number.values(), key=lambda pr: pr['pr_number'])
+  commits_without_pull_requests = sorted(
+    commits_without_pull_requests, key=lambda c: datetime.datetime.fromisoformat(c['author_date']))
 
-  body.append('')
-  body.append(f'Conductor for this PR is @{conductor}.')
+  # Construct the body text as a list of lines, joined in a single pass at the end
+  body = [
+    f'Merging {source_branch_short_sha} into `{target_branch}`.',
+    '',
+    f'Conductor for this PR is @{conductor}.',
+  ]
 
   # List all PRs merged
   if len(pull_requests) > 0:
-    body.append('')
-    body.append('Contains the following pull requests:')
-    for pr in pull_requests:
-      merger = get_merger_of_pr(repo, pr)
-      body.append(f'- #{pr.number} (@{merger})')
+    body += ['', 'Contains the following pull requests:']
+    body += [f'- #{pr["pr_number"]} (@{pr["pr_merger"]})' for pr in pull_requests]
 
   # List all commits not part of a PR
   if len(commits_without_pull_requests) > 0:
-    body.append('')
-    body.append('Contains the following commits not from a pull request:')
-    for commit in commits_without_pull_requests:
-      author_description = f' (@{commit.author.login})' if commit.author is not None else ''
-      body.append(f'- {commit.sha} - {get_truncated_commit_message(commit)}{author_description}')
-
-  body.append('')
-  body.append('Please do the following:')
+    body += ['', 'Contains the following commits not from a pull request:']
+    body += [
+      f'- {commit["sha"]} - {get_truncated_commit_message(commit)}'
+      + (f' (@{commit["author_login"]})' if commit['author_login'] is not None else '')
+      for commit in commits_without_pull_requests
+    ]
+
+  body += ['', 'Please do the following:']
   if len(conflicted_files) > 0:
-    body.append(' - [ ] Ensure `package.json` file contains the correct version.')
-    body.append(' - [ ] Add commits to this branch to resolve the merge conflicts ' +
-      'in the following files:')
-    body.extend([f'    - [ ] `{file}`' for file in conflicted_files])
-    body.append(' - [ ] Ensure another maintainer has reviewed the additional commits you added to this ' +
-      'branch to resolve the merge conflicts.')
-  body.append(' - [ ] Ensure the CHANGELOG displays the correct version and date.')
-  body.append(' - [ ] Ensure the CHANGELOG includes all relevant, user-facing changes since the last release.')
-  body.append(f' - [ ] Check that there are not any unexpected commits being merged into the `{target_branch}` branch.')
-  body.append(' - [ ] Ensure the docs team is aware of any documentation changes that need to be released.')
+    body += [
+      ' - [ ] Ensure `package.json` file contains the correct version.',
+      ' - [ ] Add commits to this branch to resolve the merge conflicts in the following files:',
+      *(f'    - [ ] `{file}`' for file in conflicted_files),
+      ' - [ ] Ensure another maintainer has reviewed the additional commits you added to this ' +
+        'branch to resolve the merge conflicts.',
+    ]
+  body += [
+    ' - [ ] Ensure the CHANGELOG displays the correct version and date.',
+    ' - [ ] Ensure the CHANGELOG includes all relevant, user-facing changes since the last release.',
+    f' - [ ] Check that there are not any unexpected commits being merged into the `{target_branch}` branch.',
+    ' - [ ] Ensure the docs team is aware of any documentation changes that need to be released.',
+  ]
 
   if not is_primary_release:
-    body.append(' - [ ] Remove and re-add the "Update dependencies" label to the PR to trigger just this workflow.')
-    body.append(' - [ ] Wait for the "Update dependencies" workflow to push a commit updating the dependencies.')
+    body += [
+      ' - [ ] Remove and re-add the "Update dependencies" label to the PR to trigger just this workflow.',
+      ' - [ ] Wait for the "Update dependencies" workflow to push a commit updating the dependencies.',
+    ]
 
-  body.append(' - [ ] Mark the PR as ready for review to trigger the full set of PR checks.')
-  body.append(' - [ ] Approve and merge this PR. Make sure `Create a merge commit` is selected rather than `Squash and merge` or `Rebase and merge`.')
+  body += [
+    ' - [ ] Mark the PR as ready for review to trigger the full set of PR checks.',
+    ' - [ ] Approve and merge this PR. Make sure `Create a merge commit` is selected rather than `Squash and merge` or `Rebase and merge`.',
+  ]
 
   if is_primary_release:
-    body.append(' - [ ] Merge the mergeback PR that will automatically be created once this PR is merged.')
-    body.append(' - [ ] Merge all backport PRs to older release branches, that will automatically be created once this PR is merged.')
+    body += [
+      ' - [ ] Merge the mergeback PR that will automatically be created once this PR is merged.',
+      ' - [ ] Merge all backport PRs to older release branches, that will automatically be created once this PR is merged.',
+    ]
 
   title = f'Merge {source_branch} into {target_branch}'
   labels = ['Update dependencies'] if not is_primary_release else []
@@ -121,56 +296,19 @@ def open_pr(
   pr.add_to_assignees(conductor)
   print(f'Assigned PR to {conductor}')
 
-# Gets a list of the SHAs of all commits that have happened on the source branch
-# since the last release to the target branch.
-# This will not include any commits that exist on the target branch
-# that aren't on the source branch.
-def get_commit_difference(repo, source_branch, target_branch):
-  # Passing split nothing means that the empty string splits to nothing: compare `''.split() == []`
-  # to `''.split('\n') == ['']`.
-  commits = run_git('log', '--pretty=format:%H', f'{ORIGIN}/{target_branch}..{ORIGIN}/{source_branch}').strip().split()
-
-  # Convert to full-fledged commit objects
-  commits = [repo.get_commit(c) for c in commits]
-
-  # Filter out merge commits for PRs
-  return list(filter(lambda c: not is_pr_merge_commit(c), commits))
-
-# Is the given commit the automatic merge commit from when merging a PR
-def is_pr_merge_commit(commit):
-  return commit.committer is not None and commit.committer.login == 'web-flow' and len(commit.parents) > 1
-
 # Gets a copy of the commit message that should display nicely
 def get_truncated_commit_message(commit):
-  message = commit.commit.message.split('\n')[0]
+  message = commit['message'].partition('\n')[0]
   if len(message) > 60:
     return f'{message[:57]}...'
   else:
     return message
 
-# Converts a commit into the PR that introduced it to the source branch.
-# Returns the PR object, or None if no PR could be found.
-def get_pr_for_commit(commit):
-  prs = commit.get_pulls()
-
-  if prs.totalCount > 0:
-    # In the case that there are multiple PRs, return the earliest one
-    prs = list(prs)
-    sorted_prs = sorted(prs, key=lambda pr: int(pr.number))
-    return sorted_prs[0]
-  else:
-    return None
-
-# Get the person who merged the pull request.
-# For most cases this will be the same as the author, but for PRs opened
-# by external contributors getting the merger will get us the GitHub
-# employee who reviewed and merged the PR.
-def get_merger_of_pr(repo, pr):
-  return repo.get_commit(pr.merge_commit_sha).author.login
-
+# Cached so that the version is read from package.json at most once per run,
+# no matter how many times it is needed.
+@functools.lru_cache(maxsize=1)
 def get_current_version():
-  with open('package.json', 'r') as f:
-    return json.load(f)['version']
+  return json.loads(pathlib.Path('package.json').read_text())['version']
 
 # `npm version` doesn't always work because of merge conflicts, so we
 # replace the version in package.json textually.
@@ -245,17 +383,9 @@ def process_changelog_for_backports(source_branch_major_version, target_branch_m
       f.write(output)
 
 def update_changelog(version):
-  if (os.path.exists('CHANGELOG.md')):
-    content = ''
-    with open('CHANGELOG.md', 'r') as f:
-      content = f.read()
-  else:
-    content = EMPTY_CHANGELOG
-
-  newContent = content.replace('[UNRELEASED]', f'{version} - {get_today_string()}', 1)
-
-  with open('CHANGELOG.md', 'w') as f:
-    f.write(newContent)
+  changelog = pathlib.Path('CHANGELOG.md')
+  content = changelog.read_text() if changelog.exists() else EMPTY_CHANGELOG
+  changelog.write_text(content.replace('[UNRELEASED]', f'{version} - {get_today_string()}', 1))
 
 
 def main():
@@ -304,7 +434,12 @@ def main():
   target_branch = args.target_branch
   is_primary_release = args.is_primary_release
 
-  repo = Github(args.github_token).get_repo(args.repository_nwo)
+  # Fetch the maximum number of items per page to minimize the number of REST
+  # requests. PyGithub's default GithubRetry already retries server errors and
+  # confirmed rate limits (sleeping until the limit resets), so the retry
+  # policy is left alone. The GraphQL path, which carries nearly all of the
+  # API traffic, has its own retry policy on GRAPHQL_SESSION.
+  repo = Github(args.github_token, per_page=100).get_repo(args.repository_nwo)
 
   # the target branch will be of the form releases/vN, where N is the major version number
   target_branch_major_version = target_branch.strip('releases/v')
@@ -316,11 +451,25 @@ def main():
 
   # Print what we intend to go
   print(f'Considering difference between {source_branch} and {target_branch}...')
-  source_branch_short_sha = run_git('rev-parse', '--short', f'{ORIGIN}/{source_branch}').strip()
+
+  # Get the head of the source branch, and the SHAs of all commits that have
+  # happened on the source branch since the last release to the target branch.
+  # The latter will not include any commits that exist on the target branch
+  # that aren't on the source branch, and passing --no-merges makes git itself
+  # filter out the automatic merge commits from merging PRs, so we never look
+  # them up via the API. Both commands are run in a single git invocation to
+  # avoid spawning a separate process for each.
+  source_branch_short_sha, commit_difference = run_git_script(
+    ['rev-parse', '--short', f'{ORIGIN}/{source_branch}'],
+    ['log', '--no-merges', '--pretty=format:%H', f'{ORIGIN}/{target_branch}..{ORIGIN}/{source_branch}'],
+  )
+  source_branch_short_sha = source_branch_short_sha.strip()
   print(f'Current head of {source_branch} is {source_branch_short_sha}.')
 
-  # See if there are any commits to merge in
-  commits = get_commit_difference(repo=repo, source_branch=source_branch, target_branch=target_branch)
+  # See if there are any commits to merge in.
+  # Passing split nothing means that the empty string splits to nothing: compare `''.split() == []`
+  # to `''.split('\n') == ['']`.
+  commits = get_commits(args.github_token, args.repository_nwo, commit_difference.split())
   if len(commits) == 0:
     print(f'No commits to merge from {source_branch} to {target_branch}.')
     return
@@ -336,7 +485,7 @@ def main():
 
   # Check if the branch already exists. If so we can abort as this script
   # has already run on this combination of branches.
-  if branch_exists_on_remote(new_branch_name):
+  if branch_exists_on_remote(repo, new_branch_name):
     print(f'Branch {new_branch_name} already exists. Nothing to do.')
     return
 
@@ -363,16 +512,16 @@ def main():
     # This commit will not exist the first time we release the v{N-1} branch from the v{N} branch, so we
     # use `git log --grep` to conditionally revert the commit.
     print('Reverting the version number and changelog updates from the last release to avoid conflicts')
-    vOlder_update_commits = run_git('log', '--grep', f'^{BACKPORT_COMMIT_MESSAGE}', '--format=%H').split()
+    vOlder_update_commit = next(run_git_lines('log', '--grep', f'^{BACKPORT_COMMIT_MESSAGE}', '--format=%H'), None)
 
-    if len(vOlder_update_commits) > 0:
-      print(f'  Reverting {vOlder_update_commits[0]}')
+    if vOlder_update_commit is not None:
+      print(f'  Reverting {vOlder_update_commit}')
       # Only revert the newest commit as older ones will already have been reverted in previous
       # releases.
-      run_git('revert', vOlder_update_commits[0], '--no-edit')
+      run_git('revert', vOlder_update_commit, '--no-edit')
 
       # Also revert the "Update checked-in dependencies" commit created by Actions.
-      update_dependencies_commit = run_git('log', '--grep', '^Update checked-in dependencies', '--format=%H').split()[0]
+      update_dependencies_commit = next(run_git_lines('log', '--grep', '^Update checked-in dependencies', '--format=%H'))
       print(f'  Reverting {update_dependencies_commit}')
       run_git('revert', update_dependencies_commit, '--no-edit')
 
@@ -382,7 +531,7 @@ def main():
     print(f'Merging {ORIGIN}/{source_branch} into the release prep branch')
     # Commit any conflicts (see the comment for `conflicted_files`)
     run_git('merge', f'{ORIGIN}/{source_branch}', allow_non_zero_exit_code=True)
-    conflicted_files = run_git('diff', '--name-only', '--diff-filter', 'U').splitlines()
+    conflicted_files = list(run_git_lines('diff', '--name-only', '--diff-filter', 'U'))
     if len(conflicted_files) > 0:
       run_git('add', '.')
       run_git('commit', '--no-edit')
@@ -390,14 +539,13 @@ def main():
     # Migrate the package version number from a vLatest version number to a vOlder version number
     print(f'Setting version number to {version} in package.json')
     replace_version_package_json(get_current_version(), version) # We rely on the `Update dependencies` workflow to update package-lock.json
-    run_git('add', 'package.json')
 
     # Migrate the changelog notes from vLatest version numbers to vOlder version numbers
     print(f'Migrating changelog notes from v{source_branch_major_version} to v{target_branch_major_version}')
     process_changelog_for_backports(source_branch_major_version, target_branch_major_version)
 
-    # Amend the commit generated by `npm version` to update the CHANGELOG
-    run_git('add', 'CHANGELOG.md')
+    # Stage both updated files in one git invocation and commit them
+    run_git('add', 'package.json', 'CHANGELOG.md')
     run_git('commit', '-m', f'{BACKPORT_COMMIT_MESSAGE}{version}')
   else:
     # If we're performing a standard release, there won't be any new commits on the target branch,